@@ -3,22 +3,51 @@ from aiohttp import web
 from typing import Any
 import toml
 import asyncio
+import contextlib
+import logging
 import os
+import signal
+
+try:
+    import uvloop
+except ImportError:  # uvloop is not available on Windows
+    uvloop = None
 
 
 async def start_server(config: dict[str, Any]):
+    if hasattr(asyncio, "eager_task_factory"):
+        # Python 3.12+: run new tasks inline until their first real await, so
+        # fire-and-forget work like analysis requests skips a loop iteration
+        asyncio.get_running_loop().set_task_factory(asyncio.eager_task_factory)
     app = await WebServer(config).build_app()
     runner = web.AppRunner(app)
     await runner.setup()
-    await web.TCPSite(runner, port=config["server"]["port"]).start()
-    stop_event = asyncio.Event()
-    await stop_event.wait()
+    try:
+        await web.TCPSite(runner, port=config["server"]["port"]).start()
+        stop_event = asyncio.Event()
+        # Stop on SIGTERM like on Ctrl+C, so the app's cleanup runs and pending
+        # writes are flushed. Signal handlers aren't supported on Windows
+        with contextlib.suppress(NotImplementedError):
+            asyncio.get_running_loop().add_signal_handler(
+                signal.SIGTERM, stop_event.set
+            )
+        await stop_event.wait()
+    finally:
+        await runner.cleanup()
 
 
 async def main():
+    # Debug logging of the analysis path is left off, so its messages are
+    # never formatted
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+    )
     config = toml.load("config.toml")
     server_task = start_server(config)
     await asyncio.gather(server_task)
 
 
-asyncio.run(main())
+if uvloop is not None:
+    uvloop.run(main())
+else:
+    asyncio.run(main())
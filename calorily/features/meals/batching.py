@@ -0,0 +1,67 @@
+from pymongo.asynchronous.collection import AsyncCollection
+import asyncio
+
+# Queued by stop() to end _run once everything queued before it is written
+_STOP = object()
+
+
+class BatchInserter:
+    """Insert documents into a collection in batches.
+
+    Callers await insert() as if it were an insert_one. Documents queued while
+    a write is in flight are sent together in the next insert_many, so bursts
+    cost one round-trip per batch while a lone insert is written right away."""
+
+    def __init__(self, collection: AsyncCollection, max_batch: int = 100):
+        self.collection = collection
+        self.max_batch = max_batch
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: asyncio.Task = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Write everything queued so far, including a batch in flight, then stop"""
+        if self._task is not None:
+            self._queue.put_nowait(_STOP)
+            await self._task
+            self._task = None
+
+    async def insert(self, document: dict) -> None:
+        """Queue a document and wait until it has been written"""
+        await self.submit(document)
+
+    def submit(self, document: dict) -> asyncio.Future:
+        """Queue a document without waiting, the returned future resolves once written"""
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((document, future))
+        return future
+
+    async def _run(self) -> None:
+        while True:
+            item = await self._queue.get()
+            if item is _STOP:
+                return
+            batch = [item]
+            while len(batch) < self.max_batch and not self._queue.empty():
+                item = self._queue.get_nowait()
+                if item is _STOP:
+                    await self._write(batch)
+                    return
+                batch.append(item)
+            await self._write(batch)
+
+    async def _write(self, batch: list) -> None:
+        try:
+            await self.collection.insert_many(
+                [document for document, _ in batch], ordered=False
+            )
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(None)
@@ -1,9 +1,37 @@
 from aiohttp import web
 from ..meals.service import MealService
-from datetime import datetime
+from ...utils import (
+    decode_image,
+    image_fingerprint,
+    json_dumps,
+    json_response,
+    read_json,
+    sniff_image_format,
+)
+from datetime import datetime, timezone
 import traceback
+import asyncio
+import logging
+import binascii
 import uuid
 
+logger = logging.getLogger(__name__)
+
+# Bytes buffered before each write of a streamed response
+_STREAM_CHUNK_SIZE = 64 * 1024
+# Largest decoded image accepted for analysis, OpenAI's limit per image
+_MAX_IMAGE_BYTES = 20 * 1024 * 1024
+
+
+def _decode_and_fingerprint(b64_img):
+    """Decode a base64 image and fingerprint it, in a single executor job.
+
+    Images over _MAX_IMAGE_BYTES are rejected anyway and aren't hashed."""
+    image_bytes, _ = decode_image(b64_img)
+    if len(image_bytes) > _MAX_IMAGE_BYTES:
+        return image_bytes, None
+    return image_bytes, image_fingerprint(image_bytes)
+
 
 class MealHandlers:
     def __init__(self, meal_service: MealService):
@@ -11,125 +39,193 @@ class MealHandlers:
 
     async def submit_meal(self, request: web.Request) -> web.Response:
         try:
-            data = await request.json()
-            user_id = request["user"]["user_id"]
+            data = await read_json(request)
+            user_id = request["user_id"]
             b64_img = data.get("b64_img")
-            meal_id = data.get("meal_id", str(uuid.uuid4()))
+            meal_id = data.get("meal_id") or str(uuid.uuid4())
 
             if not b64_img:
-                return web.json_response({"error": "b64_img is required"}, status=400)
+                return json_response({"error": "b64_img is required"}, status=400)
 
-            result = await self.meal_service.create_meal(meal_id, user_id, b64_img)
+            try:
+                # Multi-megabyte uploads are decoded and hashed off the event loop
+                loop = asyncio.get_running_loop()
+                image_bytes, fingerprint = await loop.run_in_executor(
+                    None, _decode_and_fingerprint, b64_img
+                )
+            except binascii.Error:
+                return json_response(
+                    {"error": "b64_img is not valid base64"}, status=400
+                )
+
+            # Reject what the analyzer would refuse before storing or queueing it
+            if len(image_bytes) > _MAX_IMAGE_BYTES:
+                return json_response({"error": "b64_img is too large"}, status=413)
+            image_format = sniff_image_format(image_bytes)
+            if image_format is None:
+                return json_response(
+                    {"error": "b64_img is not a JPEG, PNG, GIF or WebP image"},
+                    status=400,
+                )
+            # Trust the bytes over the data URL header
+            content_type = f"image/{image_format}"
+
+            now = datetime.now(timezone.utc)
+            result = await self.meal_service.create_meal(
+                meal_id,
+                user_id,
+                image_bytes,
+                content_type,
+                created_at=now,
+                fingerprint=fingerprint,
+            )
 
             if not result:
-                return web.json_response({"error": "meal already exists"}, status=409)
+                return json_response({"error": "meal already exists"}, status=409)
 
             # Create MealData for analysis request
             meal_data = {
                 "meal_id": meal_id,
                 "user_id": user_id,
-                "b64_img": b64_img,
-                "created_at": datetime.utcnow(),
+                "content_type": content_type,
+                "image_bytes": image_bytes,
+                "image_file_id": None,
+                "image_fingerprint": fingerprint,
+                "created_at": now,
                 "latest_analysis": None,
                 "feedback_history": [],
             }
 
-            # Start analysis task
-            await self.meal_service.request_analysis(meal_data)
+            # Queue the analysis, and don't keep a meal that can't be analyzed
+            if not await self.meal_service.request_analysis(meal_data):
+                await self.meal_service.delete_meal(meal_id)
+                return json_response(
+                    {"error": "too many pending analyses, retry later"}, status=503
+                )
 
-            return web.json_response({"meal_id": meal_id, "status": "processing"})
+            return json_response({"meal_id": meal_id, "status": "processing"})
 
         except Exception:
             traceback.print_exc()
-            return web.json_response(
-                {"error": "an unexpected error occurred"}, status=500
-            )
+            return json_response({"error": "an unexpected error occurred"}, status=500)
 
     async def submit_feedback(self, request: web.Request) -> web.Response:
         try:
-            data = await request.json()
+            data = await read_json(request)
             meal_id = data.get("meal_id")
             feedback_text = data.get("feedback")
 
             if not meal_id:
-                return web.json_response({"error": "meal_id is required"}, status=400)
+                return json_response({"error": "meal_id is required"}, status=400)
 
             if not feedback_text:
-                return web.json_response({"error": "feedback is required"}, status=400)
+                return json_response({"error": "feedback is required"}, status=400)
 
             # First fetch the meal to ensure it exists
-            meal_data = await self.meal_service.fetch_meal(meal_id)
-            if not meal_data:
-                return web.json_response({"error": "meal not found"}, status=404)
+            meal_meta = await self.meal_service.fetch_meal_meta(meal_id)
+            if not meal_meta:
+                return json_response({"error": "meal not found"}, status=404)
 
             # Add the feedback
-            success = await self.meal_service.add_feedback(meal_id, feedback_text)
-            if not success:
-                return web.json_response(
-                    {"error": "failed to add feedback"}, status=500
-                )
+            now = datetime.now(timezone.utc)
+            await self.meal_service.add_feedback(meal_id, feedback_text, timestamp=now)
 
-            # Add new feedback to meal_data optimistically with ISO formatted timestamp
-            current_time = datetime.utcnow()
-            meal_data["feedback_history"].insert(
-                0, {"feedback": feedback_text, "timestamp": current_time.isoformat()}
-            )
+            # Only the new feedback is needed to build the analysis request. The
+            # analysis worker fills in the image, so no upload or image read
+            # holds up the response
+            meal_data = {
+                "meal_id": meal_id,
+                "user_id": meal_meta["user_id"],
+                "content_type": meal_meta.get("content_type"),
+                "image_bytes": None,
+                "image_file_id": None,
+                "image_fingerprint": meal_meta.get("image_fingerprint"),
+                "created_at": meal_meta["created_at"],
+                "latest_analysis": None,
+                "feedback_history": [{"feedback": feedback_text, "timestamp": now}],
+            }
 
             # Request a new analysis with updated feedback
-            await self.meal_service.request_analysis(meal_data)
+            if not await self.meal_service.request_analysis(meal_data):
+                return json_response(
+                    {"error": "too many pending analyses, retry later"}, status=503
+                )
 
-            return web.json_response({"meal_id": meal_id, "status": "processing"})
+            return json_response({"meal_id": meal_id, "status": "processing"})
 
         except Exception:
             traceback.print_exc()
-            return web.json_response(
-                {"error": "an unexpected error occurred"}, status=500
-            )
+            return json_response({"error": "an unexpected error occurred"}, status=500)
 
     async def websocket_handler(self, request: web.Request) -> web.WebSocketResponse:
-        ws = web.WebSocketResponse()
+        # Keepalive pings are sent and answered by aiohttp itself, clients only
+        # listen so incoming messages are kept small
+        ws = web.WebSocketResponse(heartbeat=30, autoping=True, max_msg_size=64 * 1024)
         await ws.prepare(request)
 
-        user_id = request["user"]["user_id"]
+        user_id = request["user_id"]
         await self.meal_service.register_ws_connection(user_id, ws)
 
         try:
             async for msg in ws:
                 if msg.type == web.WSMsgType.ERROR:
-                    print(
-                        f"WebSocket connection closed with exception {ws.exception()}"
+                    logger.error(
+                        "WebSocket connection closed with exception %s", ws.exception()
                     )
+                elif msg.type in (
+                    web.WSMsgType.CLOSE,
+                    web.WSMsgType.CLOSING,
+                    web.WSMsgType.CLOSED,
+                ):
+                    break
         finally:
             await self.meal_service.unregister_ws_connection(user_id, ws)
 
         return ws
 
-    async def sync_analyses(self, request: web.Request) -> web.Response:
+    async def sync_analyses(self, request: web.Request) -> web.StreamResponse:
+        response = web.StreamResponse()
         try:
             # Get since parameter from query string
             since_str = request.query.get("since")
             if not since_str:
-                return web.json_response(
+                return json_response(
                     {"error": "since parameter is required"}, status=400
                 )
 
             try:
                 since = datetime.fromisoformat(since_str.replace("Z", "+00:00"))
             except ValueError:
-                return web.json_response(
+                return json_response(
                     {"error": "invalid timestamp format, use ISO 8601"}, status=400
                 )
 
-            user_id = request["user"]["user_id"]
-            analyses = await self.meal_service.fetch_analyses_since(user_id, since)
-
-            return web.json_response({"analyses": analyses})
+            user_id = request["user_id"]
+            analyses = self.meal_service.iter_analyses_since(user_id, since)
+
+            # Stream the {"analyses": [...]} body as the cursor yields, instead
+            # of materializing every analysis before sending the first byte
+            response.content_type = "application/json"
+            await response.prepare(request)
+            chunk = bytearray(b'{"analyses":[')
+            separator = b""
+            async for analysis in analyses:
+                chunk += separator + json_dumps(analysis)
+                separator = b","
+                if len(chunk) >= _STREAM_CHUNK_SIZE:
+                    await response.write(chunk)
+                    chunk = bytearray()
+            chunk += b"]}"
+            await response.write(chunk)
+            await response.write_eof()
+            return response
 
         except Exception:
             traceback.print_exc()
-            return web.json_response(
-                {"error": "an unexpected error occurred"}, status=500
-            )
+            if response.prepared:
+                # Too late for an error response, abort the connection instead
+                raise
+            return json_response({"error": "an unexpected error occurred"}, status=500)
 
     async def get_meal_analysis(self, request: web.Request) -> web.Response:
         """Handler for GET /meals/{meal_id}"""
@@ -138,11 +234,11 @@ class MealHandlers:
         analysis = await self.meal_service.get_meal_analysis(meal_id)
 
         if not analysis:
-            return web.json_response({"error": "meal not found"}, status=404)
+            return json_response({"error": "meal not found"}, status=404)
 
-        return web.json_response(analysis)
+        return json_response(analysis)
 
-    async def get_meal_image(self, request: web.Request) -> web.Response:
+    async def get_meal_image(self, request: web.Request) -> web.StreamResponse:
         """Handler for GET /meals/{meal_id}/image"""
         meal_id = request.match_info["meal_id"]
 
@@ -150,7 +246,7 @@ class MealHandlers:
         try:
             max_size = int(request.query.get("size", 0)) or None
         except ValueError:
-            return web.json_response(
+            return json_response(
                 {"error": "size parameter must be a positive integer"}, status=400
             )
 
@@ -160,49 +256,68 @@ class MealHandlers:
             if not 1 <= quality <= 100:
                 raise ValueError("quality must be between 1 and 100")
         except ValueError as e:
-            return web.json_response({"error": str(e)}, status=400)
+            return json_response({"error": str(e)}, status=400)
+
+        # Pre-rendered sizes are streamed from GridFS chunk by chunk
+        stream, content_type = await self.meal_service.open_image_stream(
+            meal_id, max_size=max_size, quality=quality
+        )
+        if stream is not None:
+            response = self._image_response(content_type, stream.length)
+            await response.prepare(request)
+            while chunk := await stream.readchunk():
+                await response.write(chunk)
+            await response.write_eof()
+            return response
 
         image_bytes, content_type = await self.meal_service.get_meal_image(
             meal_id, max_size=max_size, quality=quality
         )
 
         if not image_bytes:
-            return web.json_response({"error": "meal not found"}, status=404)
+            return json_response({"error": "meal not found"}, status=404)
+
+        response = self._image_response(content_type, len(image_bytes))
+        await response.prepare(request)
+        await response.write(image_bytes)
+        await response.write_eof()
+        return response
 
-        return web.Response(
-            body=image_bytes,
-            content_type=content_type,
+    @staticmethod
+    def _image_response(content_type: str, length: int) -> web.StreamResponse:
+        response = web.StreamResponse(
             headers={
                 "Cache-Control": "public, max-age=31536000",  # Cache for 1 year
                 "Vary": "Accept-Encoding",  # Allow CDN compression
             },
         )
+        response.content_type = content_type
+        response.content_length = length
+        return response
 
     async def delete_meal(self, request: web.Request) -> web.Response:
         """Handler for DELETE /meals/{meal_id}"""
         try:
             meal_id = request.match_info["meal_id"]
-            user_id = request["user"]["user_id"]
+            user_id = request["user_id"]
 
             # First check if the meal exists and belongs to this user
-            meal_data = await self.meal_service.fetch_meal(meal_id)
+            meal_meta = await self.meal_service.fetch_meal_meta(meal_id)
 
-            if not meal_data:
-                return web.json_response({"error": "meal not found"}, status=404)
+            if not meal_meta:
+                return json_response({"error": "meal not found"}, status=404)
 
-            if meal_data["user_id"] != user_id:
-                return web.json_response({"error": "unauthorized"}, status=403)
+            if meal_meta["user_id"] != user_id:
+                return json_response({"error": "unauthorized"}, status=403)
 
             # Delete the meal and all associated data
             success = await self.meal_service.delete_meal(meal_id)
 
             if not success:
-                return web.json_response({"error": "failed to delete meal"}, status=500)
+                return json_response({"error": "failed to delete meal"}, status=500)
 
-            return web.json_response({"status": "deleted", "meal_id": meal_id})
+            return json_response({"status": "deleted", "meal_id": meal_id})
 
         except Exception:
             traceback.print_exc()
-            return web.json_response(
-                {"error": "an unexpected error occurred"}, status=500
-            )
+            return json_response({"error": "an unexpected error occurred"}, status=500)
@@ -24,7 +24,18 @@ class FeedbackEntry(TypedDict):
 class MealData(TypedDict):
     meal_id: str
     user_id: str
-    b64_img: str
+    content_type: str
     created_at: datetime
     latest_analysis: Optional[AnalysisResult]
     feedback_history: List[FeedbackEntry]
+
+
+class AnalysisRequest(MealData):
+    # Digest of the raw image bytes, see utils.image_fingerprint. None for
+    # meals from before fingerprints, until their image is read
+    image_fingerprint: Optional[str]
+    # Raw image bytes, only base64 encoded when the request is sent
+    image_bytes: Optional[bytes]
+    # Id of the image uploaded to the OpenAI Files API. Feedback requests are
+    # queued with neither, see MealService._prepare_image
+    image_file_id: Optional[str]
@@ -1,325 +1,844 @@
-from typing import Optional, Dict
-from .models import Ingredient, AnalysisResult, FeedbackEntry, MealData
-from datetime import datetime
-from motor.motor_asyncio import AsyncIOMotorClient
-from motor.core import AgnosticDatabase, AgnosticCollection
+from typing import AsyncIterator, DefaultDict, Optional, Dict
+from .batching import BatchInserter
+from .models import Ingredient, AnalysisResult, FeedbackEntry, AnalysisRequest
+from datetime import datetime, timezone
+from pymongo import AsyncMongoClient
+from pymongo.asynchronous.collection import AsyncCollection
+from pymongo.asynchronous.database import AsyncDatabase
+from gridfs.asynchronous import AsyncGridFSBucket, AsyncGridOut
 import asyncio
+import binascii
 from aiohttp import web
-import json
 import aiohttp
-from ...gpt_api import analyze_meal
-import traceback
-import base64
+from ...gpt_api import analyze_meal, delete_file, upload_image
+from ...utils import decode_image, image_fingerprint, json_dumps
+import logging
 from bson.objectid import ObjectId
-import re
+from gridfs.errors import NoFile
+from pymongo.errors import DuplicateKeyError
 from PIL import Image
 import io
-import time
-from functools import lru_cache
+from collections import defaultdict
+from cachetools import TTLCache
+from concurrent.futures import ThreadPoolExecutor
+import os
+from hashlib import blake2b
+
+logger = logging.getLogger(__name__)
+
+# Kinds of per-meal reads kept in MealService._meal_cache
+_CACHED_READS = ("meta", "analysis")
+_MISSING = object()
+# Seconds a single websocket send may take before the client is dropped
+_WS_SEND_TIMEOUT = 5
+# Seconds between sweeps of websocket connections closed without unregistering
+_WS_PRUNE_INTERVAL = 60
+# Notifications waiting to be sent on a connection before it's dropped as too slow
+_WS_QUEUE_SIZE = 64
+# Default number of concurrent analyses, overridden by openai.analysis_workers,
+# and analyses waiting for a worker before new ones are refused
+_ANALYSIS_WORKERS = 32
+_ANALYSIS_QUEUE_SIZE = 1000
+# Largest side, in pixels, of the image variants rendered at upload
+_IMAGE_VARIANTS = (256, 768)
+# Seconds an analysis is kept in the analysis_cache collection
+_ANALYSIS_CACHE_TTL = 7 * 24 * 60 * 60
+# JPEG quality those variants are encoded with, the default quality of image requests
+_VARIANT_QUALITY = 85
+# Total bytes of served images kept in MealService._image_cache
+_IMAGE_CACHE_BYTES = 64 * 1024 * 1024
+# Static stages of the sync aggregation, reducing a user's recent analyses to
+# the newest one of each meal
+_LATEST_ANALYSIS_STAGES = (
+    {"$sort": {"timestamp": -1}},
+    {
+        "$group": {
+            "_id": "$meal_id",
+            "latest_analysis": {"$first": "$$ROOT"},
+        }
+    },
+    {
+        # Reshape the output
+        "$project": {
+            "_id": 0,
+            "meal_id": "$_id",
+            "meal_name": "$latest_analysis.meal_name",
+            "ingredients": "$latest_analysis.ingredients",
+            # Serialized by Mongo so results need no Python pass
+            "timestamp": {
+                "$dateToString": {
+                    "date": "$latest_analysis.timestamp",
+                    "format": "%Y-%m-%dT%H:%M:%S.%LZ",
+                }
+            },
+        }
+    },
+)
+
+
+def _process_image(
+    image_bytes: bytes,
+    image_format: str,
+    max_size: Optional[int],
+    quality: Optional[int],
+) -> tuple[bytes, str]:
+    """Resize and re-encode an image. CPU bound, meant to run in an executor.
+
+    Returns the encoded bytes and their content type, JPEG and WebP keep their
+    format and anything else is encoded as PNG."""
+    image = Image.open(io.BytesIO(image_bytes))
+
+    # Resize if needed
+    if max_size:
+        original_size = max(image.size)
+        if original_size > max_size:
+            ratio = max_size / original_size
+            new_size = tuple(int(dim * ratio) for dim in image.size)
+            # Let libjpeg downscale while decoding, then finish with a cheap
+            # reduce before the LANCZOS pass. No-op for other formats.
+            image.draft("RGB", new_size)
+            image = image.resize(new_size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+    # Save with quality if specified. No optimize pass, it roughly doubles
+    # encode time for a few percent of size
+    output = io.BytesIO()
+    save_params = {}
+    if quality is not None:
+        save_params["quality"] = quality
+
+    if image_format.lower() in ("jpg", "jpeg"):
+        image = image.convert("RGB")
+        image.save(output, format="JPEG", **save_params)
+        return output.getvalue(), "image/jpeg"
+    if image_format.lower() == "webp":
+        image.save(output, format="WEBP", **save_params)
+        return output.getvalue(), "image/webp"
+    image.save(output, format="PNG")
+    return output.getvalue(), "image/png"
+
+
+def _variant_name(meal_id: str, size: int) -> str:
+    """Filename of a pre-rendered image variant in the image_variants bucket"""
+    return f"{meal_id}:{size}"
 
 
 class MealService:
     def __init__(self, mongo_uri: str, database: str, app: web.Application = None):
-        # Use Motor for async MongoDB operations
-        self.client = AsyncIOMotorClient(mongo_uri)
-        self.db: AgnosticDatabase = self.client[database]
-        self.meals: AgnosticCollection = self.db.meals
-        self.analysis: AgnosticCollection = self.db.analysis
-        self.feedback: AgnosticCollection = self.db.feedback
-        # WebSocket connections mapped by user_id
-        self.ws_connections: Dict[str, set[web.WebSocketResponse]] = {}
+        # PyMongo's native asyncio client, without Motor's thread pool hop
+        # Compress traffic with zstd where the server supports it, zlib otherwise
+        self.client = AsyncMongoClient(mongo_uri, compressors="zstd,zlib")
+        self.db: AsyncDatabase = self.client[database]
+        self.meals: AsyncCollection = self.db.meals
+        self.analysis: AsyncCollection = self.db.analysis
+        self.feedback: AsyncCollection = self.db.feedback
+        self.analysis_cache: AsyncCollection = self.db.analysis_cache
+        # Raw image bytes live in GridFS, keyed by meal_id
+        self.fs = AsyncGridFSBucket(self.db, bucket_name="images")
+        # Resized copies live in their own bucket, so a client-chosen meal_id
+        # can't collide with the variant filename of another meal
+        self.variants_fs = AsyncGridFSBucket(self.db, bucket_name="image_variants")
+        # WebSocket connections mapped by user_id, each with the queue of
+        # notifications its pump task sends
+        self.ws_connections: DefaultDict[
+            str, Dict[web.WebSocketResponse, asyncio.Queue]
+        ] = defaultdict(dict)
+        self._ws_pumps: Dict[web.WebSocketResponse, asyncio.Task] = {}
+        self._ws_prune_task: Optional[asyncio.Task] = None
+        # Pending analyses, consumed by a fixed pool of workers
+        self._analysis_queue: asyncio.Queue = asyncio.Queue(
+            maxsize=_ANALYSIS_QUEUE_SIZE
+        )
+        self._analysis_workers: list[asyncio.Task] = []
         self.app = app
-        # Create an in-memory cache for processed images
-        self._image_cache = {}
+        # Recently served images keyed by meal and variant, as (bytes, content type),
+        # bounded by their total size since originals can be several megabytes
+        self._image_cache = TTLCache(
+            maxsize=_IMAGE_CACHE_BYTES, ttl=300, getsizeof=lambda v: len(v[0])
+        )
+        # Threads for resizing images off the event loop
+        self._image_executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+        # Variant renders still running by meal_id, referenced so they aren't
+        # collected and so deleting a meal can wait for its variants
+        self._render_tasks: Dict[str, asyncio.Task] = {}
+        # Image uploads to OpenAI in flight by meal_id, shared by the analyses
+        # of concurrent feedback on the same meal
+        self._image_uploads: Dict[str, asyncio.Task] = {}
+        # Successful analyses keyed by image digest and latest feedback, so a
+        # resubmitted image or repeated feedback doesn't call OpenAI again.
+        # Backed by the analysis_cache collection, which outlives restarts
+        self._analysis_cache = TTLCache(maxsize=1024, ttl=3600)
+        # Short-lived cache of meal reads keyed by (kind, meal_id), plus the
+        # loads currently in flight so concurrent readers share one query
+        self._meal_cache = TTLCache(maxsize=10_000, ttl=30)
+        self._pending_reads: Dict[tuple, asyncio.Task] = {}
+        # Shared HTTP session for analyzer calls, created in initialize()
+        self.http: Optional[aiohttp.ClientSession] = None
+        # Feedback and analyses are written in batches under bursts
+        self._feedback_writer = BatchInserter(self.feedback)
+        self._analysis_writer = BatchInserter(self.analysis)
 
     async def register_ws_connection(
         self, user_id: str, ws: web.WebSocketResponse
     ) -> None:
         """Register a new WebSocket connection for a user"""
-        if user_id not in self.ws_connections:
-            self.ws_connections[user_id] = set()
-        self.ws_connections[user_id].add(ws)
+        queue = asyncio.Queue(maxsize=_WS_QUEUE_SIZE)
+        self.ws_connections[user_id][ws] = queue
+        self._ws_pumps[ws] = asyncio.create_task(self._ws_pump(user_id, ws, queue))
 
     async def unregister_ws_connection(
         self, user_id: str, ws: web.WebSocketResponse
     ) -> None:
         """Unregister a WebSocket connection for a user"""
         if user_id in self.ws_connections:
-            self.ws_connections[user_id].discard(ws)
+            self.ws_connections[user_id].pop(ws, None)
             if not self.ws_connections[user_id]:
                 del self.ws_connections[user_id]
+        pump = self._ws_pumps.pop(ws, None)
+        if pump is not None and pump is not asyncio.current_task():
+            pump.cancel()
+
+    async def _ws_pump(
+        self, user_id: str, ws: web.WebSocketResponse, queue: asyncio.Queue
+    ) -> None:
+        """Send the notifications queued for a connection, one at a time"""
+        try:
+            while True:
+                payload = await queue.get()
+                await asyncio.wait_for(
+                    ws.send_frame(payload, web.WSMsgType.TEXT),
+                    timeout=_WS_SEND_TIMEOUT,
+                )
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            await self.unregister_ws_connection(user_id, ws)
+        finally:
+            # A dropped client reconnects and catches up through /meals/sync
+            if not ws.closed:
+                await ws.close()
+
+    async def _prune_ws_connections(self) -> None:
+        """Periodically drop connections whose handler exited without unregistering"""
+        while True:
+            await asyncio.sleep(_WS_PRUNE_INTERVAL)
+            for user_id, connections in list(self.ws_connections.items()):
+                for ws in [ws for ws in connections if ws.closed]:
+                    await self.unregister_ws_connection(user_id, ws)
 
     async def notify_user(self, user_id: str, message: dict) -> None:
-        """Send a notification to all WebSocket connections for a user"""
+        """Queue a notification for all WebSocket connections of a user"""
         if user_id not in self.ws_connections:
             return
 
-        dead_connections = set()
-        for ws in self.ws_connections[user_id]:
+        # Encode the message once and queue the same text frame for every
+        # connection, so a slow client never holds up the caller or the others
+        payload = json_dumps(message)
+        for ws, queue in list(self.ws_connections[user_id].items()):
             try:
-                await ws.send_json(message)
-            except Exception:
-                dead_connections.add(ws)
-
-        # Clean up dead connections
-        for ws in dead_connections:
-            await self.unregister_ws_connection(user_id, ws)
+                queue.put_nowait(payload)
+            except asyncio.QueueFull:
+                await self.unregister_ws_connection(user_id, ws)
 
     async def initialize(self):
         """Initialize database settings like indexes"""
+        workers = self.app["config"]["openai"].get(
+            "analysis_workers", _ANALYSIS_WORKERS
+        )
+        # Keep connections to the analyzer alive across analyses, one per worker.
+        # The API key is sent as a default header of the session
+        api_key = self.app["config"]["openai"]["api_key"]
+        self.http = aiohttp.ClientSession(
+            headers={"Authorization": f"Bearer {api_key}"},
+            timeout=aiohttp.ClientTimeout(total=60),
+            connector=aiohttp.TCPConnector(
+                limit=100,
+                limit_per_host=workers,
+                ttl_dns_cache=300,
+                keepalive_timeout=75,
+            ),
+        )
+        self._feedback_writer.start()
+        self._analysis_writer.start()
+        self._ws_prune_task = asyncio.create_task(self._prune_ws_connections())
+        self._analysis_workers = [
+            asyncio.create_task(self._analysis_worker()) for _ in range(workers)
+        ]
+
         # Create indexes
         await self.meals.create_index("meal_id", unique=True)
         await self.meals.create_index("user_id")  # For user-specific queries
         await self.analysis.create_index(
             [("meal_id", 1), ("timestamp", -1)]
         )  # For efficient latest analysis lookup
+        await self.analysis.create_index(
+            [("user_id", 1), ("timestamp", -1)]
+        )  # For syncing a user's recent analyses
         await self.feedback.create_index(
             [("meal_id", 1), ("timestamp", -1)]
         )  # For efficient feedback lookup
+        await self.analysis_cache.create_index(
+            "created_at", expireAfterSeconds=_ANALYSIS_CACHE_TTL
+        )  # Expire cached analyses
+        await self._backfill_analysis_user_ids()
+
+    async def _backfill_analysis_user_ids(self) -> None:
+        """Copy the meal's user_id onto analyses stored before it was denormalized"""
+        await self.analysis.aggregate(
+            [
+                {"$match": {"user_id": {"$exists": False}}},
+                {
+                    "$lookup": {
+                        "from": "meals",
+                        "localField": "meal_id",
+                        "foreignField": "meal_id",
+                        "pipeline": [{"$project": {"_id": 0, "user_id": 1}}],
+                        "as": "meal",
+                    }
+                },
+                {"$unwind": "$meal"},
+                {"$project": {"user_id": "$meal.user_id"}},
+                {"$merge": {"into": "analysis", "whenMatched": "merge"}},
+            ]
+        )
+
+    async def close(self):
+        """Release the resources opened in initialize"""
+        tasks = [
+            *self._analysis_workers,
+            *self._render_tasks.values(),
+            *self._image_uploads.values(),
+            *self._ws_pumps.values(),
+        ]
+        if self._ws_prune_task is not None:
+            tasks = [*tasks, self._ws_prune_task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self._feedback_writer.stop()
+        await self._analysis_writer.stop()
+        if self.http is not None:
+            await self.http.close()
+        await self.client.close()
+        self._image_executor.shutdown(wait=False, cancel_futures=True)
 
     async def create_meal(
-        self, meal_id: str, user_id: str, b64_img: str
+        self,
+        meal_id: str,
+        user_id: str,
+        image_bytes: bytes,
+        content_type: str,
+        created_at: datetime = None,
+        fingerprint: Optional[str] = None,
     ) -> Optional[str]:
         """Create a new meal entry with the provided image. Returns None if meal_id already exists."""
+        if created_at is None:
+            created_at = datetime.now(timezone.utc)
+        if fingerprint is None:
+            fingerprint = image_fingerprint(image_bytes)
+
+        # Pick the GridFS file id upfront so the meal can reference it
+        image_id = ObjectId()
         try:
             await self.meals.insert_one(
                 {
                     "meal_id": meal_id,
                     "user_id": user_id,
-                    "b64_img": b64_img,
-                    "created_at": datetime.utcnow(),
+                    "image_id": image_id,
+                    "image_fingerprint": fingerprint,
+                    "content_type": content_type,
+                    "created_at": created_at,
                 }
             )
-            return meal_id
-        except Exception:  # Duplicate key error
+        except DuplicateKeyError:
             return None
 
-    async def fetch_meal(self, meal_id: str) -> Optional[MealData]:
-        """Fetch comprehensive meal data including image, latest analysis and feedback history"""
-        # Get the meal document
-        meal_doc = await self.meals.find_one({"meal_id": meal_id})
-        if not meal_doc:
-            return None
+        try:
+            await self.fs.upload_from_stream_with_id(
+                image_id, meal_id, image_bytes, metadata={"content_type": content_type}
+            )
+        except Exception:
+            # Don't leave a meal behind without its image
+            await self.meals.delete_one({"meal_id": meal_id})
+            raise
+        self._invalidate_meal(meal_id)
+
+        # Render the smaller sizes in the background, the meal is usable without
+        task = asyncio.create_task(
+            self._render_variants(meal_id, image_bytes, content_type)
+        )
+        self._render_tasks[meal_id] = task
+        task.add_done_callback(
+            lambda done: self._forget_task(self._render_tasks, meal_id, done)
+        )
+        return meal_id
 
-        # Get the latest analysis
-        latest_analysis = await self.analysis.find_one(
-            {"meal_id": meal_id}, sort=[("timestamp", -1)]
+    @staticmethod
+    def _forget_task(tasks: Dict[str, asyncio.Task], meal_id: str, task) -> None:
+        # A meal deleted and submitted again may have a newer task running
+        if tasks.get(meal_id) is task:
+            del tasks[meal_id]
+
+    async def _render_variants(
+        self, meal_id: str, image_bytes: bytes, content_type: str
+    ) -> None:
+        """Store resized copies of a meal image so reads don't resize it"""
+        image_format = content_type.split("/")[1]
+        loop = asyncio.get_running_loop()
+        try:
+            for size in _IMAGE_VARIANTS:
+                variant, variant_type = await loop.run_in_executor(
+                    self._image_executor,
+                    _process_image,
+                    image_bytes,
+                    image_format,
+                    size,
+                    _VARIANT_QUALITY,
+                )
+                await self.variants_fs.upload_from_stream(
+                    _variant_name(meal_id, size),
+                    variant,
+                    metadata={"content_type": variant_type},
+                )
+        except Exception:
+            logger.exception("Error rendering image variants for meal %s", meal_id)
+
+    async def _load_variant(
+        self, meal_id: str, max_size: int
+    ) -> tuple[Optional[int], Optional[bytes], Optional[str]]:
+        """Load the smallest pre-rendered variant of at least max_size"""
+        for size in _IMAGE_VARIANTS:
+            if size >= max_size:
+                try:
+                    stream = await self.variants_fs.open_download_stream_by_name(
+                        _variant_name(meal_id, size)
+                    )
+                except NoFile:
+                    break
+                return size, await stream.read(), stream.metadata["content_type"]
+        return None, None, None
+
+    async def load_image(self, meal_id: str) -> tuple[Optional[bytes], Optional[str]]:
+        """Load the raw image bytes and content type of a meal from GridFS."""
+        meal = await self.fetch_meal_meta(meal_id)
+        if not meal:
+            return None, None
+        if "image_id" not in meal:
+            return await self._migrate_inline_image(meal_id)
+
+        try:
+            stream = await self.fs.open_download_stream(meal["image_id"])
+        except NoFile:
+            return None, None
+        return await stream.read(), meal["content_type"]
+
+    async def _prepare_image(self, meal_data: AnalysisRequest) -> bool:
+        """Fill in the image of an analysis request queued without one
+
+        Feedback rounds reference the image uploaded to OpenAI, uploading it on
+        first use, and only send it inline if it couldn't be uploaded. Returns
+        False if the meal has no image anymore."""
+        if meal_data["image_bytes"] is not None or meal_data["image_file_id"]:
+            return True
+        meal_id = meal_data["meal_id"]
+        meal = await self.fetch_meal_meta(meal_id)
+        if meal and meal.get("openai_file_id"):
+            meal_data["image_file_id"] = meal["openai_file_id"]
+            return True
+
+        image_bytes, content_type = await self.load_image(meal_id)
+        if not image_bytes:
+            return False
+        meal_data["content_type"] = content_type
+        # Meals from before fingerprints get one once their image is read
+        if meal_data["image_fingerprint"] is None:
+            meal_data["image_fingerprint"] = image_fingerprint(image_bytes)
+        meal_data["image_file_id"] = await self._analysis_file_id(
+            meal_id, image_bytes, content_type
         )
+        if meal_data["image_file_id"] is None:
+            meal_data["image_bytes"] = image_bytes
+        return True
+
+    async def _analysis_file_id(
+        self, meal_id: str, image_bytes: bytes, content_type: str
+    ) -> Optional[str]:
+        """Upload the meal image to OpenAI, concurrent callers share one upload"""
+        task = self._image_uploads.get(meal_id)
+        if task is None:
+            task = asyncio.create_task(
+                self._upload_analysis_image(meal_id, image_bytes, content_type)
+            )
+            self._image_uploads[meal_id] = task
+            task.add_done_callback(
+                lambda done: self._forget_task(self._image_uploads, meal_id, done)
+            )
+        return await asyncio.shield(task)
+
+    async def _upload_analysis_image(
+        self, meal_id: str, image_bytes: bytes, content_type: str
+    ) -> Optional[str]:
+        file_id = await upload_image(self.http, image_bytes, content_type, meal_id)
+        if file_id is None:
+            return None
 
-        # Get all feedback entries
-        feedback_cursor = self.feedback.find(
-            {"meal_id": meal_id}, sort=[("timestamp", -1)]
+        # Only store the id if the meal doesn't have one yet, another server
+        # may have uploaded the image first or the meal may have been deleted
+        result = await self.meals.update_one(
+            {"meal_id": meal_id, "openai_file_id": {"$exists": False}},
+            {"$set": {"openai_file_id": file_id}},
         )
-        feedback_history = [
-            {"feedback": doc["feedback"], "timestamp": doc["timestamp"]}
-            async for doc in feedback_cursor
-        ]
+        self._invalidate_meal(meal_id)
+        if result.modified_count:
+            return file_id
+        await delete_file(self.http, file_id)
+        meal = await self.fetch_meal_meta(meal_id)
+        return meal.get("openai_file_id") if meal else None
+
+    async def _migrate_inline_image(
+        self, meal_id: str
+    ) -> tuple[Optional[bytes], Optional[str]]:
+        """Move the inline base64 image of a meal created before the move to GridFS,
+        so it is decoded once instead of on every read."""
+        meal = await self.meals.find_one(
+            {"meal_id": meal_id}, projection={"b64_img": 1, "_id": 0}
+        )
+        if not meal or not meal.get("b64_img"):
+            return None, None
 
-        return {
-            "meal_id": meal_doc["meal_id"],
-            "user_id": meal_doc["user_id"],
-            "b64_img": meal_doc["b64_img"],
-            "created_at": meal_doc["created_at"],
-            "latest_analysis": (
-                {
-                    "meal_name": latest_analysis["meal_name"],
-                    "ingredients": latest_analysis["ingredients"],
-                    "timestamp": latest_analysis["timestamp"],
-                }
-                if latest_analysis
-                else None
-            ),
-            "feedback_history": feedback_history,
-        }
+        try:
+            image_bytes, content_type = decode_image(meal["b64_img"])
+        except binascii.Error:
+            logger.exception("Inline image of meal %s is not valid base64", meal_id)
+            return None, None
+        # Drop our reference to the base64 string before uploading
+        del meal
+        image_id = await self.fs.upload_from_stream(
+            meal_id, image_bytes, metadata={"content_type": content_type}
+        )
+        await self.meals.update_one(
+            {"meal_id": meal_id},
+            {
+                "$set": {
+                    "image_id": image_id,
+                    "image_fingerprint": image_fingerprint(image_bytes),
+                    "content_type": content_type,
+                },
+                "$unset": {"b64_img": ""},
+            },
+        )
+        self._invalidate_meal(meal_id)
+        return image_bytes, content_type
+
+    async def _cached_read(self, kind: str, meal_id: str, load):
+        """Return a cached read of a meal, coalescing concurrent misses into one load"""
+        key = (kind, meal_id)
+        cached = self._meal_cache.get(key, _MISSING)
+        if cached is not _MISSING:
+            return cached
+
+        task = self._pending_reads.get(key)
+        if task is None:
+
+            async def load_and_store():
+                value = await load(meal_id)
+                # Don't store a value that was invalidated while loading
+                if self._pending_reads.get(key) is asyncio.current_task():
+                    self._meal_cache[key] = value
+                return value
+
+            def forget(done: asyncio.Task):
+                if self._pending_reads.get(key) is done:
+                    del self._pending_reads[key]
+
+            task = asyncio.create_task(load_and_store())
+            self._pending_reads[key] = task
+            task.add_done_callback(forget)
+        return await asyncio.shield(task)
+
+    def _invalidate_meal(self, meal_id: str) -> None:
+        """Drop all cached reads of a meal after it was written to"""
+        for kind in _CACHED_READS:
+            self._meal_cache.pop((kind, meal_id), None)
+            self._pending_reads.pop((kind, meal_id), None)
+
+    async def fetch_meal_meta(self, meal_id: str) -> Optional[dict]:
+        """Fetch only the meal document, without analyses, feedback or image"""
+        return await self._cached_read("meta", meal_id, self._load_meal_meta)
+
+    async def _load_meal_meta(self, meal_id: str) -> Optional[dict]:
+        return await self.meals.find_one(
+            {"meal_id": meal_id}, projection={"b64_img": 0, "_id": 0}
+        )
 
     async def add_analysis(
         self,
         meal_id: str,
+        user_id: str,
         meal_name: str,
         ingredients: list[Ingredient],
         timestamp: datetime = None,
     ) -> bool:
-        """Add a new analysis for a meal"""
-        # Verify meal exists
-        meal = await self.meals.find_one({"meal_id": meal_id})
-        if not meal:
-            return False
-
+        """Add a new analysis for a meal. The caller is expected to have checked the meal exists."""
         if timestamp is None:
-            timestamp = datetime.utcnow()
+            timestamp = datetime.now(timezone.utc)
 
         # Insert the analysis
-        await self.analysis.insert_one(
+        await self._analysis_writer.insert(
             {
                 "meal_id": meal_id,
+                "user_id": user_id,
                 "meal_name": meal_name,
                 "ingredients": ingredients,
                 "timestamp": timestamp,
             }
         )
+        self._invalidate_meal(meal_id)
         return True
 
-    async def add_feedback(self, meal_id: str, feedback: str) -> bool:
-        """Add feedback for a meal"""
-        # Verify meal exists
-        meal_exists = await self.meals.find_one({"meal_id": meal_id}) is not None
-        if not meal_exists:
-            return False
+    async def add_feedback(
+        self, meal_id: str, feedback: str, timestamp: datetime = None
+    ) -> None:
+        """Add feedback for a meal. The caller is expected to have checked the meal exists.
 
-        await self.feedback.insert_one(
-            {"meal_id": meal_id, "feedback": feedback, "timestamp": datetime.utcnow()}
+        The feedback is written in the background with the next batch, this
+        doesn't wait for it. A failed write is only logged."""
+        if timestamp is None:
+            timestamp = datetime.now(timezone.utc)
+
+        written = self._feedback_writer.submit(
+            {"meal_id": meal_id, "feedback": feedback, "timestamp": timestamp}
+        )
+        written.add_done_callback(
+            lambda future: self._feedback_written(meal_id, future)
         )
-        return True
 
-    async def request_analysis(self, meal_data: MealData) -> None:
-        """Start an async task to analyze the meal image."""
+    def _feedback_written(self, meal_id: str, future: asyncio.Future) -> None:
+        self._invalidate_meal(meal_id)
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(
+                "Error storing feedback for meal %s: %s", meal_id, future.exception()
+            )
+
+    async def request_analysis(self, meal_data: AnalysisRequest) -> bool:
+        """Queue the meal image for analysis. Returns False if the queue is full."""
+        try:
+            self._analysis_queue.put_nowait(meal_data)
+        except asyncio.QueueFull:
+            return False
+        return True
 
-        async def analyze_task():
+    async def _analysis_worker(self) -> None:
+        """Analyze queued meals one at a time, for as long as the service runs"""
+        while True:
+            meal_data = await self._analysis_queue.get()
             try:
-                # Get the API key from the app config
-                api_key = self.app["config"]["openai"]["api_key"]
-
-                async with aiohttp.ClientSession() as session:
-                    # Send image to Vision API
-                    result = await analyze_meal(session, api_key, meal_data)
-
-                    if result is None:
-                        print(
-                            f"Analysis error: GPT API returned None for meal {meal_data['meal_id']}"
-                        )
-                        await self.notify_user(
-                            meal_data["user_id"],
-                            {
-                                "meal_id": meal_data["meal_id"],
-                                "event": "analysis_failed",
-                                "error": "GPT API returned no response",
-                            },
-                        )
-                        return
-
-                    if "error" in result:
-                        error_msg = f"Analysis error for meal {meal_data['meal_id']}: {result['error']}"
-                        print(error_msg)
-                        await self.notify_user(
-                            meal_data["user_id"],
-                            {
-                                "meal_id": meal_data["meal_id"],
-                                "event": "analysis_failed",
-                                "error": result["error"],
-                            },
-                        )
-                        return
-
-                    timestamp = datetime.utcnow()
-                    print(
-                        f"Got analysis result for meal {meal_data['meal_id']}: {result}"
-                    )
+                await self._run_analysis(meal_data)
+            finally:
+                self._analysis_queue.task_done()
+
+    @staticmethod
+    def _analysis_cache_key(meal_data: AnalysisRequest) -> tuple[str, Optional[str]]:
+        feedback_history = meal_data.get("feedback_history")
+        latest_feedback = feedback_history[-1]["feedback"] if feedback_history else None
+        return meal_data["image_fingerprint"], latest_feedback
+
+    @staticmethod
+    def _analysis_cache_id(cache_key: tuple[str, Optional[str]]) -> str:
+        """Key of a cached analysis in the analysis_cache collection"""
+        fingerprint, feedback = cache_key
+        if feedback is None:
+            return f"{fingerprint}:none"
+        return f"{fingerprint}:{blake2b(feedback.encode(), digest_size=16).hexdigest()}"
+
+    async def _cached_analysis(self, cache_key: tuple[str, Optional[str]]):
+        """Return the analysis cached for the key, None on a miss"""
+        result = self._analysis_cache.get(cache_key)
+        if result is None:
+            try:
+                doc = await self.analysis_cache.find_one(
+                    {"_id": self._analysis_cache_id(cache_key)}, {"result": 1}
+                )
+            except Exception:
+                # The cache is best effort, a failed lookup is a miss
+                logger.exception("Error reading cached analysis")
+                return None
+            if doc is not None:
+                result = self._analysis_cache[cache_key] = doc["result"]
+        return result
+
+    async def _store_cached_analysis(
+        self, cache_key: tuple[str, Optional[str]], result
+    ):
+        """Persist an analysis kept in _analysis_cache to the analysis_cache collection"""
+        try:
+            await self.analysis_cache.replace_one(
+                {"_id": self._analysis_cache_id(cache_key)},
+                {"result": result, "created_at": datetime.now(timezone.utc)},
+                upsert=True,
+            )
+        except Exception:
+            logger.exception("Error storing cached analysis")
 
-                    # Send notification first
-                    notification = {
-                        "meal_id": meal_data["meal_id"],
-                        "event": "analysis_complete",
-                        "data": {
-                            "meal_name": result["meal_name"],
-                            "ingredients": result["ingredients"],
-                            "timestamp": timestamp.isoformat(),
+    async def _run_analysis(self, meal_data: AnalysisRequest) -> None:
+        """Analyze the meal image and notify the user of the result"""
+        try:
+            # Send image to Vision API, unless it was just analyzed with the same
+            # feedback. Meals from before fingerprints are only looked up once
+            # their image was read and fingerprinted
+            result = None
+            fresh_key = None
+            if meal_data["image_fingerprint"] is not None:
+                result = await self._cached_analysis(
+                    self._analysis_cache_key(meal_data)
+                )
+            if result is None:
+                if not await self._prepare_image(meal_data):
+                    logger.warning("Image of meal %s not found", meal_data["meal_id"])
+                    await self.notify_user(
+                        meal_data["user_id"],
+                        {
+                            "meal_id": meal_data["meal_id"],
+                            "event": "analysis_failed",
+                            "error": "meal image not found",
                         },
-                    }
-                    print(f"Sending notification: {notification}")
-                    await self.notify_user(meal_data["user_id"], notification)
-
-                    # Then store in database
-                    print(f"Storing analysis in database...")
-                    stored = await self.add_analysis(
-                        meal_data["meal_id"],
-                        result["meal_name"],
-                        result["ingredients"],
-                        timestamp,
                     )
-                    print(f"Analysis stored: {stored}")
+                    return
+                result = await analyze_meal(self.http, meal_data)
+                if result is not None and "error" not in result:
+                    # Persisted once the user was notified, see below
+                    fresh_key = self._analysis_cache_key(meal_data)
+                    self._analysis_cache[fresh_key] = result
+
+            if result is None:
+                logger.error(
+                    "Analysis error: GPT API returned None for meal %s",
+                    meal_data["meal_id"],
+                )
+                await self.notify_user(
+                    meal_data["user_id"],
+                    {
+                        "meal_id": meal_data["meal_id"],
+                        "event": "analysis_failed",
+                        "error": "GPT API returned no response",
+                    },
+                )
+                return
 
-            except Exception as e:
-                error_msg = (
-                    f"Analysis task error for meal {meal_data['meal_id']}: {str(e)}"
+            if "error" in result:
+                logger.warning(
+                    "Analysis error for meal %s: %s",
+                    meal_data["meal_id"],
+                    result["error"],
                 )
-                print(error_msg)
-                traceback.print_exc()
                 await self.notify_user(
                     meal_data["user_id"],
                     {
                         "meal_id": meal_data["meal_id"],
                         "event": "analysis_failed",
-                        "error": "Internal server error during analysis",
+                        "error": result["error"],
                     },
                 )
+                return
 
-        # Start the analysis task without awaiting it
-        asyncio.create_task(analyze_task())
+            timestamp = datetime.now(timezone.utc)
+            logger.debug(
+                "Got analysis result for meal %s: %s", meal_data["meal_id"], result
+            )
 
-    async def fetch_analyses_since(self, user_id: str, since: datetime) -> list[dict]:
-        """Fetch all meal analyses for a user that have been updated since the given timestamp"""
-        # First get all meals for this user
-        user_meals = self.meals.find({"user_id": user_id})
-        meal_ids = [meal["meal_id"] async for meal in user_meals]
+            # Send notification first
+            notification = {
+                "meal_id": meal_data["meal_id"],
+                "event": "analysis_complete",
+                "data": {
+                    "meal_name": result["meal_name"],
+                    "ingredients": result["ingredients"],
+                    "timestamp": timestamp,
+                },
+            }
+            await self.notify_user(meal_data["user_id"], notification)
+
+            # Then store in database
+            await self.add_analysis(
+                meal_data["meal_id"],
+                meal_data["user_id"],
+                result["meal_name"],
+                result["ingredients"],
+                timestamp,
+            )
+            if fresh_key is not None:
+                await self._store_cached_analysis(fresh_key, result)
 
-        if not meal_ids:
-            return []
+        except Exception:
+            logger.exception("Analysis task error for meal %s", meal_data["meal_id"])
+            await self.notify_user(
+                meal_data["user_id"],
+                {
+                    "meal_id": meal_data["meal_id"],
+                    "event": "analysis_failed",
+                    "error": "Internal server error during analysis",
+                },
+            )
 
-        # Then get the latest analysis for each meal that's newer than since
+    async def iter_analyses_since(
+        self, user_id: str, since: datetime
+    ) -> AsyncIterator[dict]:
+        """Yield the latest analysis of each of the user's meals analyzed since the
+        given timestamp, as the cursor returns them"""
+        # Analyses carry their meal's user_id, so this is a single indexed
+        # range scan keeping the newest analysis of each meal
         pipeline = [
-            {"$match": {"meal_id": {"$in": meal_ids}, "timestamp": {"$gt": since}}},
-            {
-                # Group by meal_id and get the latest analysis
-                "$group": {"_id": "$meal_id", "latest_analysis": {"$max": "$$ROOT"}}
-            },
-            {
-                # Reshape the output
-                "$project": {
-                    "_id": 0,
-                    "meal_id": "$_id",
-                    "meal_name": "$latest_analysis.meal_name",
-                    "ingredients": "$latest_analysis.ingredients",
-                    "timestamp": "$latest_analysis.timestamp",
-                }
-            },
+            {"$match": {"user_id": user_id, "timestamp": {"$gt": since}}},
+            *_LATEST_ANALYSIS_STAGES,
         ]
 
-        cursor = self.analysis.aggregate(pipeline)
-        analyses = [doc async for doc in cursor]
-
-        # Convert datetime to ISO format string
-        for analysis in analyses:
-            analysis["timestamp"] = analysis["timestamp"].isoformat()
-
-        return analyses
+        async for doc in await self.analysis.aggregate(pipeline):
+            yield doc
 
     async def get_meal_analysis(self, meal_id: str) -> dict:
         """Get the latest analysis for a specific meal."""
+        return await self._cached_read("analysis", meal_id, self._load_meal_analysis)
+
+    async def _load_meal_analysis(self, meal_id: str) -> dict:
         analysis = await self.analysis.find_one(
-            {"meal_id": meal_id}, sort=[("timestamp", -1)]
+            {"meal_id": meal_id},
+            projection={"_id": 0, "user_id": 0},
+            sort=[("timestamp", -1)],
         )
 
         if not analysis:
             return None
 
-        # Remove MongoDB _id field and convert datetime to ISO string
-        analysis.pop("_id", None)
-        if "timestamp" in analysis:
-            analysis["timestamp"] = analysis["timestamp"].isoformat()
-
         # Ensure all required fields are present
         expected_fields = {"meal_id", "meal_name", "ingredients", "timestamp"}
         if not all(field in analysis for field in expected_fields):
-            print(f"Warning: Analysis missing fields. Found: {set(analysis.keys())}")
+            logger.warning("Analysis missing fields. Found: %s", set(analysis))
 
         return analysis
 
-    @lru_cache(maxsize=100)  # Cache up to 100 different image variations
     def _get_cache_key(
         self, meal_id: str, max_size: Optional[int], quality: int
     ) -> str:
         return f"{meal_id}_{max_size}_{quality}"
 
+    async def open_image_stream(
+        self,
+        meal_id: str,
+        max_size: Optional[int] = None,
+        quality: Optional[int] = None,
+    ) -> tuple[Optional[AsyncGridOut], Optional[str]]:
+        """Open the stored image file matching the request, when there is one to
+        send unchanged. Returns None when get_meal_image has to render it."""
+        if max_size not in _IMAGE_VARIANTS or quality not in (None, _VARIANT_QUALITY):
+            return None, None
+
+        try:
+            stream = await self.variants_fs.open_download_stream_by_name(
+                _variant_name(meal_id, max_size)
+            )
+        except NoFile:
+            return None, None
+        return stream, stream.metadata["content_type"]
+
     async def get_meal_image(
         self,
         meal_id: str,
@@ -327,103 +846,83 @@ class MealService:
         quality: Optional[int] = None,
     ) -> tuple[bytes, str]:
         """Get the meal image and optionally resize/compress it."""
-        start_time = time.time()
         cache_key = self._get_cache_key(meal_id, max_size, quality)
+        cached = self._image_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        # Start from the closest pre-rendered size when only a resize is asked
+        variant_size = None
+        if max_size and quality in (None, _VARIANT_QUALITY):
+            variant_size, image_bytes, content_type = await self._load_variant(
+                meal_id, max_size
+            )
+        if variant_size is None:
+            # Fetch the raw image bytes from GridFS
+            image_bytes, content_type = await self.load_image(meal_id)
 
-        # Debug MongoDB query
-        print(f"[MongoDB Debug] Checking indexes...")
-        indexes = await self.meals.index_information()
-        print(f"[MongoDB Debug] Available indexes: {indexes}")
-
-        # Explain the query
-        explanation = await self.meals.find(
-            {"meal_id": meal_id}, projection={"b64_img": 1, "_id": 0}
-        ).explain()
-        print(f"[MongoDB Debug] Query explanation: {explanation}")
-
-        # Fetch only the b64_img field from DB
-        meal = await self.meals.find_one(
-            {"meal_id": meal_id}, projection={"b64_img": 1, "_id": 0}
-        )
-        db_time = time.time() - start_time
-        print(f"[Image Timing] DB fetch: {db_time:.3f}s")
-
-        if not meal or not meal.get("b64_img"):
+        if not image_bytes:
             return None, None
 
-        # Extract format and header
-        format_start = time.time()
-        b64_img = meal["b64_img"]
-        format_match = re.match(r"data:image/(\w+);base64,", b64_img)
-
-        if format_match:
-            image_format = format_match.group(1)
-            b64_img = b64_img.split(",")[1]
-        else:
-            image_format = "jpeg"
-        format_time = time.time() - format_start
-        print(f"[Image Timing] Format detection: {format_time:.3f}s")
+        image_format = content_type.split("/")[1]
 
         try:
-            # Decode base64
-            decode_start = time.time()
-            image_bytes = base64.b64decode(b64_img)
-            decode_time = time.time() - decode_start
-            print(f"[Image Timing] Base64 decode: {decode_time:.3f}s")
-
-            # Only process image if resize or quality is requested
-            if max_size is not None or quality is not None:
-                # Load image
-                load_start = time.time()
-                image = Image.open(io.BytesIO(image_bytes))
-                load_time = time.time() - load_start
-                print(f"[Image Timing] Image load: {load_time:.3f}s")
-
-                # Resize if needed
-                resize_start = time.time()
-                if max_size:
-                    original_size = max(image.size)
-                    if original_size > max_size:
-                        ratio = max_size / original_size
-                        new_size = tuple(int(dim * ratio) for dim in image.size)
-                        image = image.resize(new_size, Image.Resampling.LANCZOS)
-                resize_time = time.time() - resize_start
-                print(f"[Image Timing] Resize: {resize_time:.3f}s")
-
-                # Save with quality if specified
-                save_start = time.time()
-                output = io.BytesIO()
-                save_params = {"optimize": True}
-                if quality is not None:
-                    save_params["quality"] = quality
-
-                if image_format.lower() in ("jpg", "jpeg"):
-                    image = image.convert("RGB")
-                    image.save(output, format="JPEG", **save_params)
-                else:
-                    image.save(output, format="PNG", optimize=True)
-                output.seek(0)
-                save_time = time.time() - save_start
-                print(f"[Image Timing] Save/compress: {save_time:.3f}s")
-
-                image_bytes = output.getvalue()
-
-            total_time = time.time() - start_time
-            print(f"[Image Timing] Total processing: {total_time:.3f}s")
-
-            return image_bytes, f"image/{image_format}"
-
-        except Exception as e:
-            print(f"Error processing image: {e}")
+            # Only process image if resize or quality is requested, and not
+            # already served as is by a variant of exactly the requested size
+            served_as_is = variant_size is not None and variant_size == max_size
+            if (max_size is not None or quality is not None) and not served_as_is:
+                # PIL releases the GIL while decoding, resizing and encoding,
+                # so this runs in parallel without blocking the event loop
+                result = await asyncio.get_running_loop().run_in_executor(
+                    self._image_executor,
+                    _process_image,
+                    image_bytes,
+                    image_format,
+                    max_size,
+                    quality,
+                )
+            else:
+                result = image_bytes, content_type
+            # TTLCache raises on a value larger than the whole cache
+            if len(result[0]) <= _IMAGE_CACHE_BYTES:
+                self._image_cache[cache_key] = result
+            return result
+
+        except Exception:
+            logger.exception("Error processing image of meal %s", meal_id)
             return None, None
 
     async def delete_meal(self, meal_id: str) -> bool:
-        """Delete a meal and all associated data (analysis, feedback)"""
+        """Delete a meal and all associated data (analysis, feedback, image)"""
         try:
-            # Delete from all collections
-            meal_result = await self.meals.delete_one({"meal_id": meal_id})
-            await self.analysis.delete_many({"meal_id": meal_id})
-            await self.feedback.delete_many({"meal_id": meal_id})
+            # Variants still being rendered, or an image still being uploaded to
+            # OpenAI, would be stored after the meal is deleted and never cleaned up
+            pending = {
+                task
+                for task in (
+                    self._render_tasks.get(meal_id),
+                    self._image_uploads.get(meal_id),
+                )
+                if task is not None
+            }
+            if pending:
+                await asyncio.wait(pending)
+
+            # The uploaded copy of the image is only known from the meal itself
+            meal = await self.fetch_meal_meta(meal_id)
+            uploaded = []
+            if meal and meal.get("openai_file_id"):
+                uploaded.append(delete_file(self.http, meal["openai_file_id"]))
+
+            # Delete from all collections concurrently, they don't depend on each other
+            meal_result, *_ = await asyncio.gather(
+                self.meals.delete_one({"meal_id": meal_id}),
+                self.analysis.delete_many({"meal_id": meal_id}),
+                self.feedback.delete_many({"meal_id": meal_id}),
+                self._delete_images(meal_id),
+                *uploaded,
+            )
+            self._invalidate_meal(meal_id)
 
             # Clear from image cache if present
             for key in list(self._image_cache.keys()):
@@ -433,7 +932,14 @@ class MealService:
             # Return True if the meal was found and deleted
             return meal_result.deleted_count > 0
 
-        except Exception as e:
-            print(f"Error deleting meal {meal_id}: {e}")
-            traceback.print_exc()
+        except Exception:
+            logger.exception("Error deleting meal %s", meal_id)
             return False
+
+    async def _delete_images(self, meal_id: str) -> None:
+        """Delete the GridFS files stored for a meal"""
+        async for grid_file in self.fs.find({"filename": meal_id}):
+            await self.fs.delete(grid_file._id)
+        variants = [_variant_name(meal_id, size) for size in _IMAGE_VARIANTS]
+        async for grid_file in self.variants_fs.find({"filename": {"$in": variants}}):
+            await self.variants_fs.delete(grid_file._id)
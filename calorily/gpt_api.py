@@ -1,53 +1,15 @@
 import aiohttp
-import json
+import msgspec
+import orjson
 from typing import TypedDict, Dict, Any, Optional, Union
-from .utils import clean_json, ensure_typing
-from .features.meals.models import MealData
-import traceback
+from .utils import clean_json, ensure_typing, image_data_url
+from .features.meals.models import AnalysisRequest
+import logging
 
+logger = logging.getLogger(__name__)
 
-class AnalysisResponse(TypedDict):
-    meal_name: str
-    ingredients: list[Dict[str, Any]]
-
-
-class AnalysisError(TypedDict):
-    error: str
-    response: str
-
-
-async def analyze_meal(
-    session: aiohttp.ClientSession,
-    api_key: str,
-    meal_data: MealData,
-) -> Union[AnalysisResponse, AnalysisError]:
-    """Analyze a meal image using GPT-4 Vision, with optional feedback consideration"""
-    print(f"[GPT Debug] Starting analysis for meal {meal_data['meal_id']}")
-    print(f"[GPT Debug] Has feedback: {bool(meal_data.get('feedback_history'))}")
-
-    # Determine if this is a feedback-based analysis
-    has_feedback = (
-        meal_data.get("feedback_history") and len(meal_data["feedback_history"]) > 0
-    )
-    latest_feedback = (
-        meal_data["feedback_history"][-1]["feedback"] if has_feedback else None
-    )
-
-    # Build the appropriate prompt
-    if has_feedback:
-        print(f"[GPT Debug] Using feedback: {latest_feedback}")
-        prompt = f"""You are analyzing a food image. The previous analysis received feedback indicating it might be incorrect.
-
-User feedback states: "{latest_feedback}"
-
-Please provide a new analysis, taking this feedback into account. If this is not a food image, respond with an error message.
-Your response must be a valid JSON object matching the format below.
-"""
-    else:
-        prompt = """You are analyzing a food image. Please identify the meal and its ingredients. If this is not a food image, respond with an error message.
-Your response must be a valid JSON object matching the format below."""
-
-    prompt += """
+# Describes the expected JSON output, shared by both prompts
+_FORMAT_SPEC = """
 Required JSON format:
 {
     "meal_name": "Short name (2-3 words max)",
@@ -77,12 +39,25 @@ Important requirements:
 7. Make reasonable estimates if unsure
 8. Never include units in the numbers
 9. Never include additional fields or explanations outside the JSON"""
+_INITIAL_PROMPT = (
+    """You are analyzing a food image. Please identify the meal and its ingredients. If this is not a food image, respond with an error message.
+Your response must be a valid JSON object matching the format below."""
+    + _FORMAT_SPEC
+)
+# Formatted with the user feedback, then followed by _FORMAT_SPEC
+_FEEDBACK_PROMPT = """You are analyzing a food image. The previous analysis received feedback indicating it might be incorrect.
 
-    print(f"[GPT Debug] Using prompt: {prompt}")
+User feedback states: "{feedback}"
 
-    # Prepare API request (Responses API)
-    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {api_key}"}
-    payload = {
+Please provide a new analysis, taking this feedback into account. If this is not a food image, respond with an error message.
+Your response must be a valid JSON object matching the format below.
+"""
+
+
+# The request body only varies in its prompt and image part, so it's
+# serialized once around two placeholders that are spliced in at call time
+_PAYLOAD_PREFIX, _PAYLOAD_REST = orjson.dumps(
+    {
         "model": "gpt-5",
         "text": {"format": {"type": "json_object"}},
         "reasoning": {"effort": "minimal"},
@@ -90,66 +65,194 @@ Important requirements:
             {
                 "role": "user",
                 "content": [
-                    {"type": "input_text", "text": prompt},
-                    {
-                        "type": "input_image",
-                        "image_url": f"data:image/jpeg;base64,{meal_data['b64_img']}",
-                    },
+                    {"type": "input_text", "text": "$prompt"},
+                    "$image",
                 ],
             }
         ],
         # "max_output_tokens": 2500,
     }
-    print(f"[GPT Debug] Sending request to OpenAI Responses API...")
+).split(b'"$prompt"')
+_PAYLOAD_MIDDLE, _PAYLOAD_SUFFIX = _PAYLOAD_REST.split(b'"$image"')
+_HEADERS = {"Content-Type": "application/json"}
+
+
+class AnalysisResponse(TypedDict):
+    meal_name: str
+    ingredients: list[Dict[str, Any]]
+
+
+class AnalysisError(TypedDict):
+    error: str
+    response: str
 
+
+class _Ingredient(msgspec.Struct, gc=False):
+    name: str
+    weight: float
+    carbs: float
+    proteins: float
+    fats: float
+
+
+class _Analysis(msgspec.Struct, gc=False):
+    meal_name: str
+    ingredients: list[_Ingredient]
+
+
+# Decodes and type checks well-formed model output in a single pass. The
+# structs only hold scalars and lists of scalars, so they can't form
+# reference cycles and are kept out of the garbage collector
+_ANALYSIS_DECODER = msgspec.json.Decoder(_Analysis)
+
+
+def _image_part(meal_data: AnalysisRequest) -> bytes:
+    """Serialize the input_image content part of an analysis request"""
+    # An uploaded image is referenced by id instead of being sent inline again
+    if meal_data.get("image_file_id"):
+        part = {"type": "input_image", "file_id": meal_data["image_file_id"]}
+    else:
+        data_url = image_data_url(meal_data["image_bytes"], meal_data["content_type"])
+        part = {"type": "input_image", "image_url": data_url}
+    return orjson.dumps(part)
+
+
+async def upload_image(
+    session: aiohttp.ClientSession,
+    image_bytes: bytes,
+    content_type: str,
+    filename: str,
+) -> Optional[str]:
+    """Upload an image to the OpenAI Files API, returning its file id or None"""
+    form = aiohttp.FormData()
+    form.add_field("purpose", "vision")
+    form.add_field("file", image_bytes, filename=filename, content_type=content_type)
     try:
         async with session.post(
-            "https://api.openai.com/v1/responses", headers=headers, json=payload
+            "https://api.openai.com/v1/files", data=form
         ) as response:
+            body = await response.read()
             if response.status != 200:
-                error_text = await response.text()
-                print(f"[GPT Debug] OpenAI API Error: Status {response.status}")
-                print(f"[GPT Debug] Error response: {error_text}")
+                logger.error(
+                    "OpenAI file upload error: status %s, response %s",
+                    response.status,
+                    body.decode("utf-8", errors="replace"),
+                )
+                return None
+            return orjson.loads(body)["id"]
+    except Exception:
+        logger.exception("Unexpected error during image upload")
+        return None
+
+
+async def delete_file(session: aiohttp.ClientSession, file_id: str) -> None:
+    """Delete a file previously returned by upload_image"""
+    try:
+        async with session.delete(
+            f"https://api.openai.com/v1/files/{file_id}"
+        ) as response:
+            if response.status not in (200, 404):
+                logger.error(
+                    "OpenAI file deletion error: status %s for %s",
+                    response.status,
+                    file_id,
+                )
+    except Exception:
+        logger.exception("Unexpected error during file deletion")
+
+
+def _extract_output_text(data: Dict[str, Any]) -> Optional[str]:
+    """Return the assistant text of a Responses API reply, None if there is none"""
+    # Replies have a fixed shape, so index into them directly and treat any
+    # deviation as no text
+    try:
+        for item in data["output"]:
+            if item.get("type") == "message" and item.get("role") == "assistant":
+                text = "".join(
+                    c["text"] for c in item["content"] if c.get("type") == "output_text"
+                )
+                if text:
+                    return text
+    except (KeyError, TypeError, AttributeError):
+        pass
+    return None
+
+
+async def analyze_meal(
+    session: aiohttp.ClientSession,
+    meal_data: AnalysisRequest,
+) -> Union[AnalysisResponse, AnalysisError]:
+    """Analyze a meal image using GPT-4 Vision, with optional feedback consideration.
+
+    session is the long-lived session shared by all analyses, so calls reuse
+    pooled keep-alive connections to OpenAI. Don't pass a per-call session.
+    It must send the OpenAI API key as its default Authorization header."""
+    logger.debug(
+        "Starting analysis for meal %s, has feedback: %s",
+        meal_data["meal_id"],
+        bool(meal_data.get("feedback_history")),
+    )
+
+    # Determine if this is a feedback-based analysis
+    has_feedback = (
+        meal_data.get("feedback_history") and len(meal_data["feedback_history"]) > 0
+    )
+    latest_feedback = (
+        meal_data["feedback_history"][-1]["feedback"] if has_feedback else None
+    )
+
+    # Build the appropriate prompt
+    if has_feedback:
+        logger.debug("Using feedback: %s", latest_feedback)
+        prompt = _FEEDBACK_PROMPT.format(feedback=latest_feedback) + _FORMAT_SPEC
+    else:
+        prompt = _INITIAL_PROMPT
+
+    logger.debug("Using prompt: %s", prompt)
+
+    # Prepare API request (Responses API)
+    body = b"".join(
+        (
+            _PAYLOAD_PREFIX,
+            orjson.dumps(prompt),
+            _PAYLOAD_MIDDLE,
+            _image_part(meal_data),
+            _PAYLOAD_SUFFIX,
+        )
+    )
+    logger.debug("Sending request to OpenAI Responses API")
+
+    try:
+        async with session.post(
+            "https://api.openai.com/v1/responses",
+            headers=_HEADERS,
+            data=body,
+        ) as response:
+            # Read the body once, it's only decoded to text to report errors
+            body = await response.read()
+            if response.status != 200:
+                error_text = body.decode("utf-8", errors="replace")
+                logger.error(
+                    "OpenAI API error: status %s, response %s",
+                    response.status,
+                    error_text,
+                )
                 return {
                     "error": f"API Error {response.status}",
                     "response": f"OpenAI API error: {error_text}",
                 }
 
-            response_data = await response.json()
-            print(
-                f"[GPT Debug] Got response from OpenAI Responses API: {response_data}"
-            )
+            # Parse the raw body, without going through str and stdlib json
+            response_data = orjson.loads(body)
+            logger.debug("Got response from OpenAI Responses API: %s", response_data)
 
             # Extract assistant text from Responses API
             if "output" not in response_data:
-                print("[GPT Debug] No output in response")
+                logger.error("No output in OpenAI response")
                 return {"error": "Invalid API response", "response": str(response_data)}
 
-            def extract_output_text(data: Dict[str, Any]) -> Optional[str]:
-                try:
-                    output_items = data.get("output") or []
-                    for item in output_items:
-                        if (
-                            item.get("type") == "message"
-                            and item.get("role") == "assistant"
-                        ):
-                            content_list = item.get("content") or []
-                            texts: list[str] = []
-                            for c in content_list:
-                                if c.get("type") == "output_text" and isinstance(
-                                    c.get("text"), str
-                                ):
-                                    texts.append(c["text"])
-                            if texts:
-                                return "".join(texts)
-                    # Fallback: sometimes models put text directly at top-level convenience fields (SDKs), but
-                    # in raw HTTP it's usually within output -> message -> content
-                    return None
-                except Exception:
-                    return None
-
-            message_content = extract_output_text(response_data)
-            print(f"[GPT Debug] Message content: {message_content}")
+            message_content = _extract_output_text(response_data)
+            logger.debug("Message content: %s", message_content)
 
             # Check for None content or refusal-like responses
             if message_content is None:
@@ -162,15 +265,22 @@ Important requirements:
                     )
                 else:
                     refusal_text = "No response from model"
-                print(f"[GPT Debug] Model returned no assistant text: {refusal_text}")
+                logger.warning("Model returned no assistant text: %s", refusal_text)
                 return {
                     "error": "Model returned no assistant text",
                     "response": refusal_text,
                 }
 
             try:
-                output = json.loads(clean_json(message_content))
-                print(f"[GPT Debug] Parsed JSON output: {output}")
+                return msgspec.to_builtins(_ANALYSIS_DECODER.decode(message_content))
+            except msgspec.MsgspecError:
+                # Errors, comments, stray text or numbers as strings: go through
+                # the lenient path below
+                pass
+
+            try:
+                output = orjson.loads(clean_json(message_content))
+                logger.debug("Parsed JSON output: %s", output)
 
                 # Check if the model returned an error
                 if "error" in output:
@@ -178,7 +288,7 @@ Important requirements:
 
                 # Validate required fields
                 if "meal_name" not in output or "ingredients" not in output:
-                    print("[GPT Debug] Missing required fields in output")
+                    logger.warning("Missing required fields in model output")
                     return {
                         "error": "Missing required fields",
                         "response": message_content,
@@ -187,10 +297,9 @@ Important requirements:
                 return ensure_typing(output)
 
             except Exception as parsing_error:
-                print(f"[GPT Debug] JSON parsing error: {parsing_error}")
+                logger.warning("Could not parse model output: %s", parsing_error)
                 return {"error": str(parsing_error), "response": message_content}
 
     except Exception as e:
-        print(f"[GPT Debug] Unexpected error: {e}")
-        traceback.print_exc()
+        logger.exception("Unexpected error during analysis")
         return {"error": str(e), "response": "API call failed"}
@@ -1,29 +1,38 @@
 from aiohttp import web
 import aiohttp_cors
 import traceback
+import asyncio
 import aiohttp
 from jwt import PyJWT
 import uuid
-from datetime import datetime, timedelta
-import json
-from typing import Callable, Optional
+import orjson
+from typing import AsyncIterator, Callable, Optional
 from aiohttp.web import middleware
 import jwt.exceptions
 from .features.meals.service import MealService
 from .features.meals.handlers import MealHandlers
+from .utils import json_response, read_json
 from jwt.algorithms import RSAAlgorithm
+from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicKey
 import logging
 from time import time
 from typing import Dict
+from cachetools import TTLCache
+
+# Seconds a verified token's payload is reused without checking its signature again
+_TOKEN_CACHE_TTL = 30
+# Lifetime, in seconds, of the session JWTs we issue
+_JWT_TTL = 7 * 24 * 60 * 60
 
 
 @middleware
 async def jwt_middleware(request: web.Request, handler: Callable) -> web.Response:
-    # Skip middleware for non-protected routes
+    # Skip middleware for non-protected routes, known from the resolved route
+    # rather than from its path. CORS preflights never carry a token, and
+    # are answered by aiohttp_cors without reaching a handler
     if (
-        request.path in ["/auth/apple", "/auth/dev"]
-        or request.path.startswith("/meals/")
-        and request.method == "GET"
+        request.method == "OPTIONS"
+        or request.match_info.route in request.app["public_routes"]
     ):
         return await handler(request)
 
@@ -31,27 +40,32 @@ async def jwt_middleware(request: web.Request, handler: Callable) -> web.Respons
     if request.path == "/ws":
         token = request.query.get("token")
         if not token:
-            return web.json_response({"error": "unauthorized"}, status=401)
+            return json_response({"error": "unauthorized"}, status=401)
     else:
         # Get token from Authorization header
         auth_header = request.headers.get("Authorization", "")
         if not auth_header.startswith("Bearer "):
-            return web.json_response({"error": "unauthorized"}, status=401)
+            return json_response({"error": "unauthorized"}, status=401)
         token = auth_header.split(" ")[1]
 
     try:
-        # Verify and decode the token
-        payload = request.app["jwt"].decode(
-            token, request.app["jwt_secret"], algorithms=["HS256"]
-        )
+        # Verify and decode the token, unless it was verified recently and
+        # hasn't expired since
+        payload = request.app["jwt_cache"].get(token)
+        if payload is None or payload.get("exp", 0) <= time():
+            payload = request.app["jwt"].decode(
+                token, request.app["jwt_secret"], algorithms=["HS256"]
+            )
+            request.app["jwt_cache"][token] = payload
         # Add user info to request
         request["user"] = payload
+        request["user_id"] = payload["user_id"]
     except jwt.exceptions.ExpiredSignatureError:
-        return web.json_response({"error": "token expired"}, status=401)
+        return json_response({"error": "token expired"}, status=401)
     except jwt.exceptions.InvalidTokenError:
-        return web.json_response({"error": "invalid token"}, status=401)
+        return json_response({"error": "invalid token"}, status=401)
     except Exception:
-        return web.json_response({"error": "unauthorized"}, status=401)
+        return json_response({"error": "unauthorized"}, status=401)
 
     return await handler(request)
 
@@ -61,12 +75,16 @@ class WebServer:
         self.api_key = config["openai"]["api_key"]
         self.jwt_secret = config["server"]["jwt_secret"]
         self.dev_mode = config["server"]["dev"]
-        self.session = aiohttp.ClientSession()
+        # Session for Apple's key endpoint, created on app startup by _apple_session_ctx
+        self.session: Optional[aiohttp.ClientSession] = None
         self.jwt = PyJWT()
         self.config = config
         self.apple_bundle_id = config["apple"]["bundle_id"]
-        self.apple_keys_cache: Dict[str, dict] = {}
+        # Apple's public keys by kid, parsed once per refresh rather than per sign-in
+        self.apple_keys_cache: Dict[str, RSAPublicKey] = {}
         self.apple_keys_expiry = 0
+        # Held while refreshing, so concurrent sign-ins share a single fetch
+        self._apple_keys_lock = asyncio.Lock()
         self.APPLE_KEYS_TTL = 24 * 60 * 60  # 24 hours in seconds
 
     async def load_apple_keys(self) -> None:
@@ -79,41 +97,53 @@ class WebServer:
                     logging.error("Failed to fetch Apple public keys")
                     return
 
-                keys = await response.json()
+                keys = orjson.loads(await response.read())
                 # Index keys by kid for faster lookup
-                self.apple_keys_cache = {key["kid"]: key for key in keys["keys"]}
+                self.apple_keys_cache = {
+                    key["kid"]: RSAAlgorithm.from_jwk(key) for key in keys["keys"]
+                }
                 self.apple_keys_expiry = time() + self.APPLE_KEYS_TTL
                 logging.info("Successfully cached Apple public keys")
         except Exception as e:
             logging.error(f"Error loading Apple public keys: {e}")
 
-    async def get_apple_public_key(self, kid: str) -> Optional[dict]:
+    async def get_apple_public_key(self, kid: str) -> Optional[RSAPublicKey]:
         """Get Apple's public key from cache or fetch if needed."""
-        current_time = time()
-
-        # Refresh cache if expired or empty
-        if current_time > self.apple_keys_expiry or not self.apple_keys_cache:
-            await self.load_apple_keys()
+        # Refresh cache if expired or empty, checking again once the lock is
+        # held in case another request just refreshed it
+        if time() > self.apple_keys_expiry or not self.apple_keys_cache:
+            async with self._apple_keys_lock:
+                if time() > self.apple_keys_expiry or not self.apple_keys_cache:
+                    await self.load_apple_keys()
 
         return self.apple_keys_cache.get(kid)
 
+    def _issue_token(self, user_id: str) -> str:
+        """Sign one of our session JWTs for the user"""
+        return self.jwt.encode(
+            # PyJWT takes exp as a plain epoch, no datetime arithmetic needed
+            {"user_id": user_id, "exp": int(time()) + _JWT_TTL},
+            self.jwt_secret,
+            algorithm="HS256",
+        )
+
     async def create_apple_session(self, request):
         try:
             if not request.content_type == "application/json":
-                return web.json_response(
+                return json_response(
                     {"error": "Content-Type must be application/json"}, status=400
                 )
 
             try:
-                data = await request.json()
-            except json.JSONDecodeError:
-                return web.json_response(
+                data = await read_json(request)
+            except orjson.JSONDecodeError:
+                return json_response(
                     {"error": "Invalid JSON in request body"}, status=400
                 )
 
             identity_token = data.get("identity_token")
             if not identity_token:
-                return web.json_response({"error": "invalid input"}, status=400)
+                return json_response({"error": "invalid input"}, status=400)
 
             # Decode the token header without verification to get the key ID
             try:
@@ -121,17 +151,12 @@ class WebServer:
                 kid = header["kid"]
             except Exception as e:
                 logging.error(f"Error decoding token header: {e}")
-                return web.json_response({"error": "invalid token"}, status=400)
+                return json_response({"error": "invalid token"}, status=400)
 
             # Get the public key from Apple
-            key_data = await self.get_apple_public_key(kid)
-            if not key_data:
-                return web.json_response(
-                    {"error": "unable to verify token"}, status=400
-                )
-
-            # Convert the JWK to PEM format
-            public_key = RSAAlgorithm.from_jwk(json.dumps(key_data))
+            public_key = await self.get_apple_public_key(kid)
+            if public_key is None:
+                return json_response({"error": "unable to verify token"}, status=400)
 
             try:
                 # Verify and decode the token
@@ -144,7 +169,7 @@ class WebServer:
                 )
             except jwt.exceptions.InvalidTokenError as e:
                 logging.error(f"Token validation failed: {e}")
-                return web.json_response({"error": "invalid token"}, status=400)
+                return json_response({"error": "invalid token"}, status=400)
 
             # Extract the stable user ID from Apple's sub claim
             user_id = payload["sub"]
@@ -153,60 +178,63 @@ class WebServer:
             logging.info(f"Apple Sign In successful for user: {user_id}")
 
             # Create our own JWT
-            token = self.jwt.encode(
-                {"user_id": user_id, "exp": datetime.utcnow() + timedelta(days=7)},
-                self.jwt_secret,
-                algorithm="HS256",
-            )
+            token = self._issue_token(user_id)
 
-            return web.json_response({"jwt": token, "user_id": user_id})
+            return json_response({"jwt": token, "user_id": user_id})
 
         except Exception as e:
             logging.error(f"Unexpected error in create_apple_session: {e}")
             traceback.print_exc()
-            return web.json_response(
-                {"error": "an unexpected error happened"}, status=500
-            )
+            return json_response({"error": "an unexpected error happened"}, status=500)
 
     async def create_dev_session(self, request):
         if not self.dev_mode:
-            return web.json_response({"error": "dev mode disabled"}, status=403)
+            return json_response({"error": "dev mode disabled"}, status=403)
 
         try:
             if not request.content_type == "application/json":
-                return web.json_response(
+                return json_response(
                     {"error": "Content-Type must be application/json"}, status=400
                 )
 
             try:
-                data = await request.json()
-            except json.JSONDecodeError:
-                return web.json_response(
+                data = await read_json(request)
+            except orjson.JSONDecodeError:
+                return json_response(
                     {"error": "Invalid JSON in request body"}, status=400
                 )
 
             user_id = data.get("user_id")
             if not user_id:
-                return web.json_response({"error": "invalid input"}, status=400)
+                return json_response({"error": "invalid input"}, status=400)
 
-            token = self.jwt.encode(
-                {"user_id": user_id, "exp": datetime.utcnow() + timedelta(days=7)},
-                self.jwt_secret,
-                algorithm="HS256",
-            )
+            token = self._issue_token(user_id)
 
-            return web.json_response({"jwt": token, "user_id": user_id})
+            return json_response({"jwt": token, "user_id": user_id})
         except Exception:
             traceback.print_exc()
-            return web.json_response(
-                {"error": "an unexpected error happened"}, status=500
-            )
+            return json_response({"error": "an unexpected error happened"}, status=500)
+
+    async def _apple_session_ctx(self, app: web.Application) -> AsyncIterator[None]:
+        """Own the session for Apple's key endpoint for the lifetime of the app"""
+        # A bounded timeout so a stalled key fetch can't hold up sign-ins
+        self.session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=10, connect=5),
+            connector=aiohttp.TCPConnector(
+                limit_per_host=10, ttl_dns_cache=300, keepalive_timeout=75
+            ),
+        )
+        # Load Apple keys at startup
+        await self.load_apple_keys()
+        yield
+        await self.session.close()
 
     async def build_app(self):
         # create db indexes
         app = web.Application(middlewares=[jwt_middleware], client_max_size=100000000)
         app["jwt"] = self.jwt
         app["jwt_secret"] = self.jwt_secret
+        app["jwt_cache"] = TTLCache(maxsize=10_000, ttl=_TOKEN_CACHE_TTL)
         app["config"] = self.config
 
         # Initialize services
@@ -219,16 +247,14 @@ class WebServer:
 
         self.meal_handlers = MealHandlers(self.meal_service)
 
-        async def close_session(app):
-            await self.session.close()
+        async def close_services(app):
+            await self.meal_service.close()
 
-        app.on_cleanup.append(close_session)
-
-        # Load Apple keys at startup
-        await self.load_apple_keys()
+        app.cleanup_ctx.append(self._apple_session_ctx)
+        app.on_cleanup.append(close_services)
 
         # Updated routes
-        app.add_routes(
+        routes = app.add_routes(
             [
                 web.post("/auth/apple", self.create_apple_session),
                 web.post("/auth/dev", self.create_dev_session),
@@ -241,6 +267,16 @@ class WebServer:
                 web.delete("/meals/{meal_id}", self.meal_handlers.delete_meal),
             ]
         )
+        # Routes served without a token, every other one goes through jwt_middleware
+        public_handlers = (
+            self.create_apple_session,
+            self.create_dev_session,
+            self.meal_handlers.get_meal_analysis,
+            self.meal_handlers.get_meal_image,
+        )
+        app["public_routes"] = frozenset(
+            route for route in routes if route.handler in public_handlers
+        )
 
         cors = aiohttp_cors.setup(
             app,
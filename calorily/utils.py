@@ -1,20 +1,38 @@
+from aiohttp import web
+from hashlib import blake2b
+from math import inf
+import orjson
+import pybase64
 import re
+from typing import Any, Dict
 
+_COMMENT_RE = re.compile(r"//.*")
+# First unsigned number in a string like "12.5g"
+_FLOAT_RE = re.compile(r"\d+(\.\d+)?")
+
+
+def clean_json(json_string: str) -> str:
+    # Well-formed output, the usual case in JSON mode, needs no cleaning
+    if "//" not in json_string:
+        stripped = json_string.strip()
+        if stripped[:1] == "{" and stripped[-1:] == "}":
+            return stripped
 
-def clean_json(json_string):
     # Remove single-line comments
-    cleaned_string = re.sub(r"//.*", "", json_string)
+    cleaned_string = _COMMENT_RE.sub("", json_string)
 
-    # Extract JSON object
-    match = re.search(r"\{.*\}", cleaned_string, re.DOTALL)
-    return match.group().strip() if match else ""
+    # Extract JSON object, from the first opening to the last closing brace
+    start = cleaned_string.find("{")
+    end = cleaned_string.rfind("}")
+    return cleaned_string[start : end + 1].strip() if -1 < start < end else ""
 
 
-def calculate_calories(carbs, proteins, fats):
-    return (carbs * 4) + (proteins * 4) + (fats * 9)
+def calculate_calories(carbs: float, proteins: float, fats: float) -> float:
+    # Carbs and proteins share 4 kcal/g, so they're summed before multiplying
+    return (carbs + proteins) * 4 + fats * 9
 
 
-def ensure_typing(data):
+def ensure_typing(data: Dict[str, Any]) -> Dict[str, Any]:
     if "ingredients" in data:
         for ingredient in data["ingredients"]:
             ingredient["weight"] = extract_float(ingredient.get("weight", 0))
@@ -24,10 +42,98 @@ def ensure_typing(data):
     return data
 
 
-def extract_float(value):
-    if isinstance(value, (float, int)):
-        return float(value)
-    if isinstance(value, str):
-        match = re.search(r"\d+(\.\d+)?", value)
-        return float(match.group()) if match else 0.0
-    return 0.0
+def _extract_float_str(value: str) -> float:
+    # Well-formed numbers are parsed directly, the regex only digs numbers
+    # out of strings like "12g". Negative, nan and inf values still go
+    # through it, which keeps only their digits
+    try:
+        number = float(value)
+    except ValueError:
+        pass
+    else:
+        if 0 <= number < inf:
+            return number
+    match = _FLOAT_RE.search(value)
+    return float(match.group()) if match else 0.0
+
+
+# extract_float by exact input type, parsed JSON only holds these exact types
+_EXTRACT_FLOAT = {
+    float: float,
+    int: float,
+    bool: float,
+    str: _extract_float_str,
+}
+
+
+def extract_float(value: Any) -> float:
+    extract = _EXTRACT_FLOAT.get(type(value))
+    return extract(value) if extract is not None else 0.0
+
+
+_DATA_URI_RE = re.compile(r"data:image/(\w+);base64,")
+
+
+def decode_image(b64_img):
+    """Decode a base64 image, optionally prefixed with a data URI header.
+
+    Returns the raw image bytes and their content type."""
+    image_format = "jpeg"
+    if b64_img.startswith("data:"):
+        format_match = _DATA_URI_RE.match(b64_img)
+        if format_match:
+            image_format = format_match.group(1)
+            # Slice past the header instead of splitting the whole payload
+            b64_img = b64_img[format_match.end() :]
+    # Not validated, so line-wrapped base64 from MIME style encoders decodes.
+    # Uploads that aren't images are rejected from the decoded bytes instead
+    return pybase64.b64decode(b64_img), f"image/{image_format}"
+
+
+# Leading bytes of the image formats the analyzer accepts
+_IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+)
+
+
+def sniff_image_format(image_bytes):
+    """Return the format of image bytes from their signature, None if unsupported"""
+    for signature, image_format in _IMAGE_SIGNATURES:
+        if image_bytes.startswith(signature):
+            return image_format
+    # WebP is a RIFF container, identified past its size field
+    if image_bytes[:4] == b"RIFF" and image_bytes[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+def image_fingerprint(image_bytes):
+    """Short digest identifying an image's content, for caching and dedup only"""
+    return blake2b(image_bytes, digest_size=16).hexdigest()
+
+
+def image_data_url(image_bytes, content_type):
+    """Return raw image bytes as a base64 data URL"""
+    return f"data:{content_type};base64,{pybase64.b64encode(image_bytes).decode()}"
+
+
+def json_dumps(data):
+    """Serialize to JSON bytes with orjson, naive datetimes are treated as UTC"""
+    return orjson.dumps(data, option=orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z)
+
+
+def json_response(data, status=200):
+    """Same as aiohttp's web.json_response, serialized with orjson"""
+    return web.Response(
+        body=json_dumps(data),
+        content_type="application/json",
+        status=status,
+    )
+
+
+async def read_json(request):
+    """Parse the JSON body of a request with orjson"""
+    return orjson.loads(await request.read())
@@ -2,12 +2,19 @@
 import asyncio
 import aiohttp
 import argparse
-import json
-from datetime import datetime
+import sys
+import orjson
+
+try:
+    import uvloop
+except ImportError:  # uvloop is not available on Windows
+    uvloop = None
 
 
 # local: "ws://localhost:8080/ws"
 BACKEND = "ws://localhost:8080/ws"
+# Messages are indented for reading in a terminal, kept on one line when piped
+_JSON_OPTION = orjson.OPT_INDENT_2 if sys.stdout.isatty() else 0
 
 
 async def subscribe_to_meals(jwt_token: str):
@@ -16,19 +23,24 @@ async def subscribe_to_meals(jwt_token: str):
 
     async with aiohttp.ClientSession() as session:
         try:
-            async with session.ws_connect(url) as ws:
+            # Negotiate permessage-deflate, which the server accepts by default
+            async with session.ws_connect(url, compress=15) as ws:
                 print("Connected to WebSocket server")
                 print("Waiting for messages...")
 
                 async for msg in ws:
                     if msg.type == aiohttp.WSMsgType.TEXT:
                         try:
-                            data = json.loads(msg.data)
-                            timestamp = datetime.fromisoformat(
-                                data["data"]["timestamp"]
+                            data = orjson.loads(msg.data)
+                            # Only printed, so the ISO string is shown as sent.
+                            # analysis_failed events carry no data
+                            timestamp = data.get("data", {}).get("timestamp", "-")
+                            pretty = orjson.dumps(data, option=_JSON_OPTION)
+                            # One write per message rather than one per print
+                            sys.stdout.write(
+                                f"\nReceived message at {timestamp}\n"
+                                f"{pretty.decode()}\n"
                             )
-                            print("\nReceived message at", timestamp)
-                            print(json.dumps(data, indent=2))
                         except Exception as e:
                             print(f"Error parsing message: {e}")
                             print("Raw message:", msg.data)
@@ -52,7 +64,10 @@ def main():
     args = parser.parse_args()
 
     try:
-        asyncio.run(subscribe_to_meals(args.jwt))
+        if uvloop is not None:
+            uvloop.run(subscribe_to_meals(args.jwt))
+        else:
+            asyncio.run(subscribe_to_meals(args.jwt))
     except KeyboardInterrupt:
         print("\nSubscriber stopped by user")
 